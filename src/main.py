@@ -1,24 +1,30 @@
 import asyncio
-import io
+import hashlib
 import logging
+import multiprocessing
 import os
-import shutil
+import re
+import stat
 import sys
+import tempfile
+import time
 import unicodedata
-import uuid
+import zipfile
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor
 from typing import List
 
-import aiofiles as aiof
+import anyio
 import uvicorn
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import Depends, FastAPI, File, Request, UploadFile, HTTPException
 from fastapi.openapi.docs import (
     get_redoc_html,
     get_swagger_ui_html,
     get_swagger_ui_oauth2_redirect_html,
 )
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 
 try:
     from libmat2 import parser_factory, UNSUPPORTED_EXTENSIONS
@@ -42,8 +48,54 @@ torrent, wav, wmv, zip, …""",
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# do not re-create the pool with every request, only create it once
-pool = ProcessPoolExecutor()
+def _worker_init():
+    # pre-import mat2 in each worker at spawn time so the first task it
+    # receives does not pay the import cost
+    import libmat2  # noqa: F401
+
+
+# do not re-create the pool with every request, only create it once;
+# forkserver avoids forking the whole FastAPI process image per worker
+_MAX_WORKERS = max(2, os.cpu_count() or 2)
+_mp_context = multiprocessing.get_context('forkserver') if sys.platform == 'linux' else None
+pool = ProcessPoolExecutor(max_workers=_MAX_WORKERS, mp_context=_mp_context, initializer=_worker_init)
+
+# bound in-flight executor jobs so request bursts wait here instead of
+# queueing deep inside the pool while holding their spooled uploads
+_pool_sem = asyncio.Semaphore(_MAX_WORKERS)
+
+# spool uploads to a RAM-backed filesystem when available, so mat2's re-read
+# of the file never has to go back to disk
+_UPLOAD_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# content-addressed LRU cache of extracted metadata: re-showing an identical
+# file skips parsing entirely
+_META_CACHE: OrderedDict = OrderedDict()
+_META_CACHE_SIZE = 512
+
+# check_dependencies shells out to the optional mat2 backends, so cache its
+# result briefly — liveness probes hit /healthz far more often than deps change
+_dep_cache = {'ts': 0.0, 'val': None}
+_DEP_CACHE_TTL = 30  # seconds
+
+# reject uploads bigger than this before (and while) spooling them to disk
+_MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+
+# translation table mapping every control-category codepoint to None,
+# built once so __print_without_chars is a single C-level str.translate
+_CC_TABLE = {cp: None for cp in range(sys.maxunicode + 1)
+             if unicodedata.category(chr(cp)).startswith('C')}
+
+
+@app.middleware("http")
+async def static_cache_headers(request: Request, call_next):
+    response = await call_next(request)
+    if request.url.path.startswith('/static/') and response.status_code in (200, 304):
+        # the bundled docs assets only change with a release — let clients
+        # and CDNs keep them instead of revalidating on every docs visit;
+        # never stamp this on 404s, they must stay uncached
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 @app.get("/", include_in_schema=False)
@@ -72,7 +124,45 @@ async def redoc_html():
     )
 
 
+def _safe_suffix(upload_name) -> str:
+    """ The extension is what picks the mat2 parser; everything else about
+    the user-supplied name is untrusted and must not reach the filesystem.
+    """
+    name = os.path.basename(upload_name or '')
+    # splitext would truncate compound tar extensions to .gz/.bz2/.xz,
+    # for which mimetypes finds no type and mat2 no parser
+    for compound in ('.tar.gz', '.tar.bz2', '.tar.xz'):
+        if name.lower().endswith(compound):
+            return compound
+    ext = os.path.splitext(name)[1][:16]
+    return re.sub(r'[^A-Za-z0-9.]', '', ext)
+
+
+async def _check_size(request: Request):
+    # fail fast on the declared size; the streaming loop enforces the real one
+    if int(request.headers.get('content-length', 0)) > _MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="file too large")
+
+
+async def _spool_upload(file: UploadFile, filename: str, digest=None) -> int:
+    """ Stream the upload to `filename` chunk by chunk — O(chunk) memory —
+    optionally feeding each chunk to `digest` while it is still hot in cache.
+    Aborts with 413 as soon as the running size exceeds the limit.
+    """
+    size = 0
+    async with await anyio.open_file(filename, "wb") as out:
+        while chunk := await file.read(1 << 20):
+            size += len(chunk)
+            if size > _MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="file too large")
+            if digest is not None:
+                digest.update(chunk)
+            await out.write(chunk)
+    return size
+
+
 @app.post("/show/",
+          dependencies=[Depends(_check_size)],
           tags=["Metadata"],
           response_class=JSONResponse,
           responses={
@@ -94,48 +184,67 @@ async def show(file: UploadFile = File(...), sandbox: bool = True):
     """
     Extracts and return the file metadata
     """
-    filename = f'{uuid.uuid4()}{file.filename}'
-    async with aiof.open(filename, "wb") as out:
-        await out.write(await file.read())
-        await out.flush()
+    suffix = _safe_suffix(file.filename)
+    fd, filename = tempfile.mkstemp(dir=_UPLOAD_DIR, suffix=suffix)
+    os.close(fd)
+    digest = hashlib.blake2b(digest_size=16)
+    loop = asyncio.get_running_loop()
+
     try:
-        print(os.path.abspath(filename))
-        metadata = await get_meta(os.path.abspath(filename), sandbox)
+        size = await _spool_upload(file, filename, digest)
+        # the suffix picks the parser, so identical bytes under a different
+        # extension must not share a cache entry
+        cache_key = (digest.digest(), size, suffix.lower(), sandbox)
+        metadata = _META_CACHE.get(cache_key)
+        if metadata is not None:
+            _META_CACHE.move_to_end(cache_key)
+        else:
+            async with _pool_sem:
+                metadata = await loop.run_in_executor(pool, get_meta, filename, sandbox)
+            _META_CACHE[cache_key] = metadata
+            if len(_META_CACHE) > _META_CACHE_SIZE:
+                _META_CACHE.popitem(last=False)
         return JSONResponse(metadata,
                             media_type='text/plain')
+    except ValueError as e:  # handle exceptions from get_meta
+        raise HTTPException(status_code=400, detail=str(e))
     except HTTPException as e:  # pass through http exceptions
         raise e
     except Exception as e:  # any other exceptions
         __print_without_chars("[-] something went wrong when processing %s: %s" % (filename, e))
         raise HTTPException(status_code=500, detail="Metadata cannot be extracted")
     finally:
-        os.remove(filename)
+        # off-loop removal, so a slow filesystem does not stall other requests
+        await anyio.Path(filename).unlink(missing_ok=True)
 
 
-async def get_meta(filename: str, sandbox: bool):
+def get_meta(filename: str, sandbox: bool):
     if not __check_file(filename):
-        raise HTTPException(status_code=500, detail="File error")
+        raise RuntimeError("File error")
 
     try:
         p, mtype = parser_factory.get_parser(filename)  # type: ignore
     except ValueError as e:
         __print_without_chars("[-] something went wrong when processing %s: %s" % (filename, e))
-        raise HTTPException(status_code=400, detail="something went wrong during processing: {}".format(e))
+        raise ValueError("something went wrong during processing: {}".format(e))
     if p is None:
         __print_without_chars("[-] %s's format (%s) is not supported" % (filename, mtype))
-        raise HTTPException(status_code=400, detail="format ({}) is not supported".format(mtype))
+        raise ValueError("format ({}) is not supported".format(mtype))
     p.sandbox = sandbox
     return p.get_meta()
 
 
 def __check_file(filename: str, mode: int = os.R_OK) -> bool:
-    if not os.path.exists(filename):
+    try:
+        st = os.stat(filename)
+    except (FileNotFoundError, NotADirectoryError):
         __print_without_chars("[-] %s doesn't exist." % filename)
         return False
-    elif not os.path.isfile(filename):
+    if not stat.S_ISREG(st.st_mode):
         __print_without_chars("[-] %s is not a regular file." % filename)
         return False
-    elif not os.access(filename, mode):
+    # os.access is still needed for the ACL-aware permission check
+    if not os.access(filename, mode):
         mode_str: List[str] = list()
         if mode & os.R_OK:
             mode_str += 'readable'
@@ -147,6 +256,7 @@ def __check_file(filename: str, mode: int = os.R_OK) -> bool:
 
 
 @app.post("/clean/",
+          dependencies=[Depends(_check_size)],
           tags=["Metadata"],
           response_class=StreamingResponse,
           responses={
@@ -164,36 +274,38 @@ async def clean(file: UploadFile = File(...),
     """
     Remove metadata from file and return the cleaned file
     """
-    filename = f'{uuid.uuid4()}{file.filename}'
-    async with aiof.open(filename, "wb") as out:
-        await out.write(await file.read())
-        await out.flush()
-    prefix, extension = os.path.splitext(file.filename)
+    prefix = os.path.basename(os.path.splitext(file.filename or '')[0])
+    extension = _safe_suffix(file.filename)
+    fd, filename = tempfile.mkstemp(dir=_UPLOAD_DIR, suffix=extension)
+    os.close(fd)
 
     policy = UnknownMemberPolicy(unknown_members)
     # if policy == UnknownMemberPolicy.KEEP:
     #     logging.warning('Keeping unknown member files may leak metadata in the resulting file!')
 
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
 
+    is_success = False
     try:
-        is_success = await loop.run_in_executor(pool, clean_meta, os.path.abspath(filename), lightweight, True, sandbox,
-                                                policy)
+        await _spool_upload(file, filename)
+        async with _pool_sem:
+            is_success = await loop.run_in_executor(pool, clean_meta, filename, lightweight, True,
+                                                    sandbox, policy)
         if is_success:
-            data = await cache_delete_file(filename)
-            if data is not None:
-                return StreamingResponse(data,
-                                         media_type='application/octet-stream',
-                                         headers={
-                                             'Content-Disposition': 'attachment; filename="{}"'.format(
-                                                 prefix + '_metaclean' + extension)})
+            # file was cleaned in place, stream it straight from disk and
+            # delete it once the response has been sent
+            return FileResponse(filename,
+                                media_type='application/octet-stream',
+                                filename=prefix + '_metaclean' + extension,
+                                background=BackgroundTask(os.remove, filename))
     except (ValueError, RuntimeError) as e:  # handle exceptions from clean_meta
         raise HTTPException(status_code=400, detail=str(e))
     except HTTPException as e:
         raise e
     finally:
-        if os.path.isfile(os.path.abspath(filename)):
-            os.remove(os.path.abspath(filename))
+        # off-loop removal, so a slow filesystem does not stall other requests
+        if not is_success:
+            await anyio.Path(filename).unlink(missing_ok=True)
 
     raise HTTPException(status_code=400, detail="Failed to remove metadata")
 
@@ -218,34 +330,108 @@ def clean_meta(filename: str, is_lightweight: bool, inplace: bool, sandbox: bool
 
     try:
         logging.debug('Cleaning %s…', filename)
+        src_mode = os.stat(filename).st_mode
         ret = p.remove_all()
         if ret is True:
-            shutil.copymode(filename, p.output_filename)
+            os.chmod(p.output_filename, src_mode)
             if inplace is True:
-                os.rename(p.output_filename, filename)
+                os.replace(p.output_filename, filename)
         return ret
     except RuntimeError as e:
         __print_without_chars("[-] %s can't be cleaned: %s" % (filename, e))
         raise RuntimeError("can't be cleaned: {}".format(e))
 
 
-async def cache_delete_file(filename):
-    cached_file = io.BytesIO()
-    async with aiof.open(os.path.abspath(filename), 'rb') as fo:
-        cached_file.write(await fo.read())
-    cached_file.seek(0)
-    os.remove(os.path.abspath(filename))
-    return cached_file
+@app.post("/clean-batch/",
+          dependencies=[Depends(_check_size)],
+          tags=["Metadata"],
+          response_class=StreamingResponse,
+          responses={
+              200: {
+                  "content": {"application/zip": {
+                      "example": "(zip archive of the files with metadata removed)"
+                  }},
+                  "description": "Return a zip archive of the files with metadata removed.",
+              }
+          }, )
+async def clean_batch(files: List[UploadFile] = File(...),
+                      lightweight: bool = False,
+                      unknown_members: UnknownMemberPolicy = UnknownMemberPolicy.ABORT,
+                      sandbox: bool = True):
+    """
+    Remove metadata from several files at once and return them as a zip archive.
+    Files that cannot be cleaned are left out of the archive.
+    """
+    policy = UnknownMemberPolicy(unknown_members)
+    loop = asyncio.get_running_loop()
+
+    async def clean_one(path):
+        async with _pool_sem:
+            return await loop.run_in_executor(pool, clean_meta, path, lightweight, True, sandbox, policy)
+
+    uploads = []
+    arc_counts: dict = {}
+    try:
+        for file in files:
+            prefix = os.path.basename(os.path.splitext(file.filename or '')[0])
+            extension = _safe_suffix(file.filename)
+            fd, filename = tempfile.mkstemp(dir=_UPLOAD_DIR, suffix=extension)
+            os.close(fd)
+            # duplicate entry names would silently shadow each other on
+            # extraction, so number the repeats
+            arcname = prefix + '_metaclean' + extension
+            count = arc_counts.get(arcname, 0)
+            arc_counts[arcname] = count + 1
+            if count:
+                arcname = '%s_metaclean_%d%s' % (prefix, count, extension)
+            uploads.append((filename, arcname))
+            await _spool_upload(file, filename)
+
+        # fan the parse jobs out across the pool; the semaphore keeps the
+        # number of in-flight jobs bounded
+        results = await asyncio.gather(*[clean_one(path) for path, _ in uploads],
+                                       return_exceptions=True)
+        cleaned = [entry for entry, ret in zip(uploads, results) if ret is True]
+        if not cleaned:
+            raise HTTPException(status_code=400, detail="Failed to remove metadata")
+
+        fd, zip_path = tempfile.mkstemp(dir=_UPLOAD_DIR, suffix='.zip')
+        os.close(fd)
+        try:
+            await loop.run_in_executor(None, _zip_stored, cleaned, zip_path)
+        except Exception:
+            await anyio.Path(zip_path).unlink(missing_ok=True)
+            raise
+        return FileResponse(zip_path,
+                            media_type='application/zip',
+                            filename='metaclean.zip',
+                            background=BackgroundTask(os.remove, zip_path))
+    finally:
+        # off-loop removal, so a slow filesystem does not stall other requests
+        for path, _ in uploads:
+            await anyio.Path(path).unlink(missing_ok=True)
+
+
+def _zip_stored(entries, zip_path: str):
+    # ZIP_STORED: the cleaned files are mostly compressed formats already,
+    # re-compressing them would only burn CPU
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for path, arcname in entries:
+            archive.write(path, arcname)
 
 
 # @app.get("/health", tags=["Health"])
 @app.get("/healthz", tags=["Health"])
-def get_health():
+async def get_health():
+    now = time.monotonic()
+    if _dep_cache['val'] is None or now - _dep_cache['ts'] > _DEP_CACHE_TTL:
+        _dep_cache['val'] = await asyncio.to_thread(check_dependencies)
+        _dep_cache['ts'] = now
     # __print_without_chars("Dependencies for mat2 %s:" % )
-    for key, value in sorted(check_dependencies().items()):
+    for key, value in sorted(_dep_cache['val'].items()):
         __print_without_chars(
             '- %s: %s %s' % (key, 'yes' if value['found'] else 'no', '(optional)' if not value['required'] else ''))
-    return "OK"
+    return JSONResponse("OK")
 
 
 def __print_without_chars(s: str):
@@ -253,8 +439,8 @@ def __print_without_chars(s: str):
     We might use 'Cc' instead of 'C', but better safe than sorry
     https://www.unicode.org/reports/tr44/#GC_Values_Table
     """
-    print(''.join(ch for ch in s if not unicodedata.category(ch).startswith('C')))
+    print(s.translate(_CC_TABLE))
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=5000, log_level="info")
+    uvicorn.run("main:app", host="0.0.0.0", port=5000, loop="uvloop", http="httptools", log_level="info")